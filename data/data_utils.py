@@ -12,7 +12,7 @@ import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from data.dataloader import TrainDataLoader, NegativeSampler
+from data.dataloader import TrainDataLoader, NegativeSampler, FullEvalDataLoader
 from data.dataset import TrainRecDataset, FullEvalDataset, TrainUserRecDataset
 
 LOG_FILT_DATA_PATH = "log_filtering_data.txt"
@@ -231,10 +231,11 @@ def get_dataloader(conf: dict, split_set: str) -> DataLoader:
                      f"- train_n_workers: {conf['running_settings']['train_n_workers']} \n")
 
     elif split_set == 'val':
-        dataloader = DataLoader(
+        dataloader = FullEvalDataLoader(
             FullEvalDataset(
                 data_path=conf['dataset_path'],
                 split_set='val',
+                device=conf['device'] if 'device' in conf else 'cpu',
             ),
             batch_size=conf['eval_batch_size'],
             num_workers=conf['running_settings']['eval_n_workers'],
@@ -244,10 +245,11 @@ def get_dataloader(conf: dict, split_set: str) -> DataLoader:
                      f"- eval_n_workers: {conf['running_settings']['eval_n_workers']} \n")
 
     elif split_set == 'test':
-        dataloader = DataLoader(
+        dataloader = FullEvalDataLoader(
             FullEvalDataset(
                 data_path=conf['dataset_path'],
                 split_set='test',
+                device=conf['device'] if 'device' in conf else 'cpu',
             ),
             batch_size=conf['eval_batch_size'],
             num_workers=conf['running_settings']['eval_n_workers'],
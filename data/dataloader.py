@@ -7,7 +7,7 @@ import torch
 from torch.utils.data import DataLoader, Dataset, Sampler
 from torch.utils.data.dataloader import T_co, _worker_init_fn_t
 
-from data.dataset import TrainRecDataset
+from data.dataset import TrainRecDataset, FullEvalDataset
 
 
 class InteractionSampler(ABC):
@@ -39,7 +39,8 @@ class NegativeSampler(InteractionSampler):
         self.squashing_factor_pop_sampling = squashing_factor_pop_sampling
 
         self.n_items = train_dataset.n_items
-        self.pop_distribution = train_dataset.pop_distribution.copy()
+        # float64 copy, np.random.choice is strict on the probabilities summing to 1
+        self.pop_distribution = train_dataset.pop_distribution.astype(np.float64)
 
         if neg_sampling_strategy == 'uniform':
             self.neg_sampling_fun = self._neg_sample_uniform
@@ -92,7 +93,9 @@ class TrainDataLoader(DataLoader):
     def _neg_sampling_collate_fn(self, batch):
         """
         It performs the negative sampling procedure for the batch.
-        @param batch: Batch is a list of tuples. Each tuple has the user_idx in [0] and item_idxs in [1].
+        @param batch: Batch is a list of tuples. Each tuple has the user_idx in [0] and item_idxs in [1]. When the
+            batch is fetched with __getitems__ (see TrainRecDataset), batch is instead a tuple of arrays with the
+            user_idxs in [0] and item_idxs in [1].
         @return:
             -user_idxs. Tensor containing the user_idxs. Shape is [batch_size].
             - item_idxs. Tensor containing the item_idxs. Shape is [batch_size, n_pos (usually 1) + n_neg].
@@ -102,9 +105,12 @@ class TrainDataLoader(DataLoader):
 
         """
         n_neg = self.interaction_sampler.n_neg
-        batch_size = len(batch)
-        user_idxs = np.array([x[0] for x in batch]).astype(np.int64)
-        item_pos_idxs = np.array([x[1] for x in batch])
+        if isinstance(batch, tuple):
+            user_idxs, item_pos_idxs = batch[0], batch[1]
+        else:
+            user_idxs = np.array([x[0] for x in batch]).astype(np.int64)
+            item_pos_idxs = np.array([x[1] for x in batch])
+        batch_size = len(user_idxs)
         n_pos = item_pos_idxs.shape[-1] if len(item_pos_idxs.shape) > 1 else 1
 
         item_neg_idxs = np.empty((batch_size, n_neg), dtype=np.int64)
@@ -127,3 +133,40 @@ class TrainDataLoader(DataLoader):
         labels = np.zeros_like(items_idxs, dtype=float)
         labels[:, :n_pos] = 1.
         return torch.from_numpy(user_idxs), torch.from_numpy(items_idxs), torch.from_numpy(labels)
+
+
+class FullEvalDataLoader(DataLoader):
+    """
+    DataLoader for FullEvalDataset. If the dataset is on a device other than cpu, the dense rows of each batch are built
+    on the device (see FullEvalDataset.get_dense_batch). Since the device matrices cannot be used by the worker
+    processes, batches are then loaded in the main process.
+    """
+
+    def __init__(self, dataset: FullEvalDataset, batch_size: Optional[int] = 1, num_workers: int = 0,
+                 pin_memory: bool = False, timeout: float = 0, worker_init_fn: Optional[_worker_init_fn_t] = None,
+                 multiprocessing_context=None, generator=None, *, prefetch_factor: Optional[int] = None,
+                 persistent_workers: bool = False):
+
+        if dataset.device != 'cpu':
+            collate_function = self._device_collate_fn
+            if num_workers > 0:
+                logging.info(f'FullEvalDataLoader: dataset is on {dataset.device}, num_workers is set to 0')
+            num_workers = 0
+            prefetch_factor = None
+        else:
+            collate_function = None
+
+        super().__init__(dataset, batch_size, num_workers=num_workers, collate_fn=collate_function,
+                         pin_memory=pin_memory, timeout=timeout, worker_init_fn=worker_init_fn,
+                         multiprocessing_context=multiprocessing_context, generator=generator,
+                         prefetch_factor=prefetch_factor, persistent_workers=persistent_workers)
+
+    def _device_collate_fn(self, batch):
+        """
+        @param batch: List of user_idxs.
+        @return:
+            - user_idxs. Tensor containing the user_idxs. Shape is [batch_size].
+            - labels. Dense tensor with the items of the users. Shape is [batch_size, n_items].
+            - exclude_data. Dense boolean tensor with the items to exclude. Shape is [batch_size, n_items].
+        """
+        return self.dataset.get_dense_batch(torch.tensor(batch, dtype=torch.long))
@@ -1,5 +1,8 @@
+import functools
+import hashlib
 import logging
 import os
+import shutil
 
 import numpy as np
 import pandas as pd
@@ -20,9 +23,36 @@ should be the following csv files:
         Eval when split_set == val.
 - listening_history_test.csv: same as listening_history_train.csv but contains the data used for test. Used in Eval 
         when split_set == test.
+TrainRecDataset also stores the processed training data in a `.cache_train_<hash>` directory inside 'data_path' (see
+TrainRecDataset for more details).
 """
 
 
+@functools.lru_cache(maxsize=8)
+def _load_lhs_arrays(data_path: str, split_set: str):
+    """
+    Parses listening_history_{split_set}.csv and returns the user_idx and item_idx columns as int32 arrays.
+    The result is memoized since the same file is read by several datasets of a run (e.g. the training data is also
+    loaded by FullEvalDataset). For this reason, the arrays are read-only. The memoized arrays are kept in memory until
+    clear_lhs_cache is called.
+    """
+    # Only the indices are needed. The pyarrow engine parses the file with multiple threads.
+    lhs = pd.read_csv(os.path.join(data_path, f'listening_history_{split_set}.csv'), engine='pyarrow',
+                      usecols=['user_idx', 'item_idx'], dtype={'user_idx': 'int32', 'item_idx': 'int32'})
+    user_idxs = lhs['user_idx'].to_numpy(np.int32)
+    item_idxs = lhs['item_idx'].to_numpy(np.int32)
+    user_idxs.flags.writeable = False
+    item_idxs.flags.writeable = False
+    return user_idxs, item_idxs
+
+
+def clear_lhs_cache():
+    """
+    Frees the interaction arrays memoized by _load_lhs_arrays. To be called once all the datasets have been built.
+    """
+    _load_lhs_arrays.cache_clear()
+
+
 class RecDataset(data.Dataset):
     """
     Dataset to hold Recommender System data in the format of a pandas dataframe.
@@ -43,6 +73,7 @@ class RecDataset(data.Dataset):
         self.n_user_groups = None  # optional
 
         self.lhs = None
+        self.n_interactions = None
 
         self._load_data()
 
@@ -52,7 +83,7 @@ class RecDataset(data.Dataset):
                      f'- split_set: {self.split_set} \n'
                      f'- n_users: {self.n_users} \n'
                      f'- n_items: {self.n_items} \n'
-                     f'- n_interactions: {len(self.lhs)} \n'
+                     f'- n_interactions: {self.n_interactions} \n'
                      f'- n_user_groups: {len(self.n_user_groups)} \n')
 
     def _load_data(self):
@@ -69,19 +100,28 @@ class RecDataset(data.Dataset):
         if len(grouping_columns) > 1:
             self.user_to_user_group = dict()
             self.n_user_groups = dict()
+            user_order = np.argsort(user_idxs['user_idx'].to_numpy())
             for grouping_column in grouping_columns:
                 grouping_column_name = grouping_column.split('_group_idx')[0]
-                mapping = user_idxs[['user_idx', grouping_column]].set_index('user_idx').sort_index()[grouping_column]
-                mapping = torch.tensor(mapping)
+                group_idxs = user_idxs[grouping_column].to_numpy(np.int64, copy=False)
+                # Group idxs are sorted by user_idx
+                mapping = group_idxs[user_order]
+                mapping = torch.from_numpy(mapping)
                 self.user_to_user_group[grouping_column_name] = mapping
-                self.n_user_groups[grouping_column_name] = user_idxs[grouping_column].nunique()
+                # Group idxs are dense integers, so the number of groups is the max + 1
+                self.n_user_groups[grouping_column_name] = int(group_idxs.max()) + 1
 
-        self.lhs = self._load_lhs(self.split_set)
+        self._load_interactions()
 
         logging.info('End loading data')
 
+    def _load_interactions(self):
+        self.lhs = self._load_lhs(self.split_set)
+        self.n_interactions = len(self.lhs)
+
     def _load_lhs(self, split_set: str):
-        return pd.read_csv(os.path.join(self.data_path, f'listening_history_{split_set}.csv'))
+        user_idxs, item_idxs = _load_lhs_arrays(self.data_path, split_set)
+        return pd.DataFrame({'user_idx': user_idxs, 'item_idx': item_idxs}, copy=False)
 
     def __len__(self):
         raise NotImplementedError("RecDataset does not support __len__ or __getitem__. Please use TrainRecDataset for"
@@ -98,52 +138,138 @@ class TrainRecDataset(RecDataset):
     dataset of positive interaction. It also stores the item popularity distribution over the training data.
 
     Additional notes:
-    The data is loaded twice. Once the data is stored in a COO matrix to easily iterate over the dataset. Once in a CSR
-    matrix to carry out fast negative sampling with the user-wise slicing functionalities (see also collate_fn in data/dataloader.py)
+    The data is loaded twice. Once the data is stored as two int64 arrays (interaction_user_idxs, interaction_item_idxs)
+    with the user and item idxs of the interactions to easily iterate over the dataset (the values of the COO matrix are
+    always 1 and are not stored). Once in a CSR matrix to carry out fast negative sampling with the user-wise slicing
+    functionalities (see also collate_fn in data/dataloader.py)
+    After the first build, the arrays of the matrices are saved in data_path/.cache_train_<hash> as .npy files. The
+    hash depends on size and modification time of listening_history_train.csv. Following builds memory-map the files
+    and skip parsing the csv file (unless delete_lhs is False, in which case the dataframe is needed). If the cache
+    cannot be written (e.g. read-only data_path), the dataset is built in memory as usual.
     """
 
-    def __init__(self, data_path: str, delete_lhs: bool = True):
+    CACHE_KEYS = ['indptr', 'indices', 'row', 'col', 'pop']
+
+    def __init__(self, data_path: str, delete_lhs: bool = True, use_cache: bool = True):
         """
         :param data_path: Path to the directory with listening_history_train.csv, user_idxs.csv, item_idxs.csv
         :param delete_lhs: Whether the pandas dataframe should be deleted after creating the iteration/sampling mtxs.
+            The underlying arrays are freed only after clear_lhs_cache is called.
+        :param use_cache: Whether the iteration/sampling mtxs should be loaded from (and saved to) the cache directory.
         """
 
-        super().__init__(data_path, 'train')
-
+        # Needed already when loading the data
         self.delete_lhs = delete_lhs
+        self.use_cache = use_cache
+        self.cache_path = None
 
-        self.iteration_matrix = None
+        super().__init__(data_path, 'train')
+
+        # int64 user and item idxs of each interaction (entries of the COO matrix)
+        self.interaction_user_idxs = None
+        self.interaction_item_idxs = None
         self.sampling_matrix = None
 
         self.pop_distribution = None
+        self.user_nnz = None
 
         self._prepare_data()
 
         self.name = 'TrainRecDataset'
         logging.info(f'Built {self.name} module \n'
-                     f'- delete_lhs: {self.delete_lhs} \n')
+                     f'- delete_lhs: {self.delete_lhs} \n'
+                     f'- use_cache: {self.use_cache} \n'
+                     f'- cache_path: {self.cache_path} \n')
+
+    def _load_interactions(self):
+        lhs_stat = os.stat(os.path.join(self.data_path, 'listening_history_train.csv'))
+        cache_hash = hashlib.md5(
+            f'{lhs_stat.st_size}_{lhs_stat.st_mtime_ns}_{self.n_users}_{self.n_items}'.encode()).hexdigest()
+        self.cache_path = os.path.join(self.data_path, f'.cache_train_{cache_hash}')
+
+        if self.use_cache and self.delete_lhs and os.path.isdir(self.cache_path):
+            # The csv file is not parsed. Matrices are loaded from the cache in _prepare_data
+            logging.info(f'Found cached training data in {self.cache_path}')
+            self.n_interactions = len(np.load(os.path.join(self.cache_path, 'indices.npy'), mmap_mode='r'))
+        else:
+            super()._load_interactions()
 
     def _prepare_data(self):
-        self.iteration_matrix = sp.coo_matrix(
-            (np.ones(len(self.lhs), dtype=np.int16), (self.lhs.user_idx, self.lhs.item_idx)),
-            shape=(self.n_users, self.n_items))
+        if self.lhs is None:
+            self._load_cache()
+        else:
+            self._build_matrices()
+            if self.use_cache and not os.path.isdir(self.cache_path):
+                self._save_cache()
 
-        self.sampling_matrix = sp.csr_matrix(self.iteration_matrix)
-
-        item_popularity = np.array(self.iteration_matrix.sum(axis=0)).flatten()
-        self.pop_distribution = item_popularity / item_popularity.sum()
+        # Number of interactions of each user
+        self.user_nnz = np.diff(self.sampling_matrix.indptr).astype(np.float32)
 
         if self.delete_lhs:
             del self.lhs
 
+    def _build_matrices(self):
+        rows = self.lhs['user_idx'].to_numpy(np.int32, copy=False)
+        cols = self.lhs['item_idx'].to_numpy(np.int32, copy=False)
+
+        data = np.ones(len(rows), dtype=np.int16)
+
+        # The COO -> CSR conversion of scipy already returns a matrix in canonical format
+        self.sampling_matrix = sp.csr_matrix((data, (rows, cols)), shape=(self.n_users, self.n_items))
+        # int64 indices of the interactions, so that __getitem__ does not need to cast at each call
+        iteration_matrix = self.sampling_matrix.tocoo(copy=False)
+        self.interaction_user_idxs = np.ascontiguousarray(iteration_matrix.row, dtype=np.int64)
+        self.interaction_item_idxs = np.ascontiguousarray(iteration_matrix.col, dtype=np.int64)
+
+        item_popularity = np.bincount(cols, minlength=self.n_items).astype(np.float32)
+        self.pop_distribution = item_popularity / item_popularity.sum()
+
+    def _save_cache(self):
+        cache_arrays = {
+            'indptr': self.sampling_matrix.indptr,
+            'indices': self.sampling_matrix.indices,
+            'row': self.interaction_user_idxs,
+            'col': self.interaction_item_idxs,
+            'pop': self.pop_distribution
+        }
+        # Files are written to a temporary directory first, so that concurrent runs never see a partial cache
+        tmp_cache_path = f'{self.cache_path}.tmp{os.getpid()}'
+        try:
+            os.makedirs(tmp_cache_path, exist_ok=True)
+            for key in self.CACHE_KEYS:
+                np.save(os.path.join(tmp_cache_path, f'{key}.npy'), cache_arrays[key])
+            os.rename(tmp_cache_path, self.cache_path)
+            logging.info(f'Saved training data to cache {self.cache_path}')
+        except OSError as e:
+            # E.g. read-only data_path, disk full, or another run already saved the cache. The in-memory matrices are used
+            logging.warning(f'Could not save training data to cache {self.cache_path}: {e}')
+            shutil.rmtree(tmp_cache_path, ignore_errors=True)
+
+    def _load_cache(self):
+        cache_arrays = {key: np.load(os.path.join(self.cache_path, f'{key}.npy'), mmap_mode='r')
+                        for key in self.CACHE_KEYS}
+
+        data = np.ones(len(cache_arrays['indices']), dtype=np.int16)
+        self.sampling_matrix = sp.csr_matrix((data, cache_arrays['indices'], cache_arrays['indptr']),
+                                             shape=(self.n_users, self.n_items), copy=False)
+        self.interaction_user_idxs = cache_arrays['row']
+        self.interaction_item_idxs = cache_arrays['col']
+
+        self.pop_distribution = cache_arrays['pop']
+
     def __len__(self):
-        return self.iteration_matrix.nnz
+        return len(self.interaction_user_idxs)
 
     def __getitem__(self, index):
-        user_idx = self.iteration_matrix.row[index].astype('int64')
-        item_idx = self.iteration_matrix.col[index].astype('int64')
+        return self.interaction_user_idxs[index], self.interaction_item_idxs[index], 1.
 
-        return user_idx, item_idx, 1.
+    def __getitems__(self, indices):
+        """
+        Returns the batch as a tuple of arrays (user_idxs, item_idxs, labels) instead of a list of tuples.
+        See also collate_fn in data/dataloader.py
+        """
+        return (self.interaction_user_idxs[indices], self.interaction_item_idxs[indices],
+                np.ones(len(indices), dtype=np.float32))
 
 
 class FullEvalDataset(RecDataset):
@@ -153,58 +279,130 @@ class FullEvalDataset(RecDataset):
     that needs to be excluded from the evaluation:
     During validation, items in the training data for a user are excluded as labels
     During test, items in the training data and validation for a user are excluded as labels
+
+    Additional notes:
+    If device is not 'cpu', the indptr/indices of the matrices are also copied on the device. In this case the dataset
+    only returns the user idxs and the dense rows are built for the whole batch on the device by get_dense_batch (see
+    also FullEvalDataLoader in data/dataloader.py)
     """
 
-    def __init__(self, data_path: str, split_set: str, delete_lhs: bool = True):
+    def __init__(self, data_path: str, split_set: str, delete_lhs: bool = True, device: str = 'cpu'):
         """
         :param data_path: Path to the directory with listening_history_{val,test}.csv, user_idxs.csv, item_idxs.csv
         :param split_set: Either 'val' or 'test'
         :param delete_lhs: Whether the pandas dataframe should be deleted after creating the iteration/sampling mtxs.
+            The underlying arrays are freed only after clear_lhs_cache is called.
+        :param device: Device where the dense rows of the batches are built.
         """
 
         super().__init__(data_path, split_set)
 
         self.delete_lhs = delete_lhs
+        self.device = device
 
         self.idx_to_user = None
         self.iteration_matrix = None
         self.exclude_data = None
 
+        self._device_matrices = None
+
         self._prepare_data()
 
         self.name = 'FullEvalDataset'
 
         logging.info(f'Built {self.name} module \n'
-                     f'- delete_lhs: {self.delete_lhs} \n')
+                     f'- delete_lhs: {self.delete_lhs} \n'
+                     f'- device: {self.device} \n')
 
     def _prepare_data(self):
+        # Boolean values, so that duplicate entries are merged into a single 1 (see __getitem__ and __getitems__)
         self.iteration_matrix = sp.csr_matrix(
-            (np.ones(len(self.lhs), dtype=np.int16), (self.lhs.user_idx, self.lhs.item_idx)),
-            shape=(self.n_users, self.n_items))
+            (np.ones(len(self.lhs), dtype=bool),
+             (self.lhs['user_idx'].to_numpy(np.int32, copy=False), self.lhs['item_idx'].to_numpy(np.int32, copy=False))),
+            shape=(self.n_users, self.n_items), dtype=bool)
 
         # Load Train data as well
-        train_lhs = self._load_lhs('train')
-        self.exclude_data = sp.csr_matrix(
-            (np.ones(len(train_lhs), dtype=bool), (train_lhs.user_idx, train_lhs.item_idx)),
-            shape=(self.n_users, self.n_items)
-        )
+        exclude_lhss = [self._load_lhs('train')]
         # If 'split_test' load also Valid data
         if self.split_set == 'test':
-            val_lhs = self._load_lhs('val')
-            self.exclude_data += sp.csr_matrix(
-                (np.ones(len(val_lhs), dtype=bool), (val_lhs.user_idx, val_lhs.item_idx)),
-                shape=(self.n_users, self.n_items)
-            )
+            exclude_lhss.append(self._load_lhs('val'))
+
+        # The matrix is built only once (duplicate entries are merged by scipy)
+        exclude_rows = np.concatenate([exclude_lhs['user_idx'].to_numpy() for exclude_lhs in exclude_lhss])
+        exclude_cols = np.concatenate([exclude_lhs['item_idx'].to_numpy() for exclude_lhs in exclude_lhss])
+        self.exclude_data = sp.csr_matrix(
+            (np.ones(len(exclude_rows), dtype=bool), (exclude_rows, exclude_cols)),
+            shape=(self.n_users, self.n_items), dtype=bool
+        )
+
+        self._csr_indptr = self.iteration_matrix.indptr
+        self._csr_indices = self.iteration_matrix.indices
+        self._exclude_indptr = self.exclude_data.indptr
+        self._exclude_indices = self.exclude_data.indices
+
+        if self.device != 'cpu':
+            self._device_matrices = {
+                name: (torch.from_numpy(mtx.indptr.astype(np.int64)).to(self.device),
+                       torch.from_numpy(mtx.indices.astype(np.int64)).to(self.device))
+                for name, mtx in [('iteration', self.iteration_matrix), ('exclude', self.exclude_data)]
+            }
 
         if self.delete_lhs:
             del self.lhs
 
+    def _densify_on_device(self, name: str, user_idxs: torch.Tensor, dtype: torch.dtype):
+        indptr, indices = self._device_matrices[name]
+
+        starts = indptr[user_idxs]
+        lengths = indptr[user_idxs + 1] - starts
+        # Position of each entry of the batch rows in indices
+        batch_offsets = torch.cumsum(lengths, 0) - lengths
+        entry_rows = torch.repeat_interleave(torch.arange(len(user_idxs), device=self.device), lengths)
+        entry_positions = torch.arange(len(entry_rows), device=self.device) + (starts - batch_offsets)[entry_rows]
+
+        dense = torch.zeros(len(user_idxs), self.n_items, dtype=dtype, device=self.device)
+        dense[entry_rows, indices[entry_positions]] = 1
+        return dense
+
+    def get_dense_batch(self, user_idxs: torch.Tensor):
+        """
+        Builds the dense rows of iteration and exclude data for a batch of users directly on the device.
+        :param user_idxs: Tensor of user idxs. Shape is [batch_size]
+        :return: user_idxs, labels, exclude_data. All on the device.
+        """
+        user_idxs = user_idxs.to(self.device)
+        return (user_idxs,
+                self._densify_on_device('iteration', user_idxs, torch.float32),
+                self._densify_on_device('exclude', user_idxs, torch.bool))
+
     def __len__(self):
         return self.n_users
 
     def __getitem__(self, user_index):
-        return user_index, self.iteration_matrix[user_index].toarray().squeeze().astype(
-            'float32'), self.exclude_data[user_index].toarray().squeeze().astype('bool')
+        if self._device_matrices is not None:
+            # Dense rows are built by get_dense_batch
+            return user_index
+
+        # Scattering the CSR row directly into dense vectors (avoids building a sparse row matrix per call)
+        user_iteration = np.zeros(self.n_items, dtype=np.float32)
+        user_iteration[self._csr_indices[self._csr_indptr[user_index]:self._csr_indptr[user_index + 1]]] = 1.
+
+        user_exclude = np.zeros(self.n_items, dtype=bool)
+        user_exclude[self._exclude_indices[self._exclude_indptr[user_index]:self._exclude_indptr[user_index + 1]]] = True
+
+        return user_index, user_iteration, user_exclude
+
+    def __getitems__(self, user_indices):
+        """
+        Slices the rows of all the users in the batch with a single call on the CSR matrices.
+        """
+        if self._device_matrices is not None:
+            # Dense rows are built by get_dense_batch
+            return user_indices
+
+        batch_iteration = self.iteration_matrix[user_indices].toarray().astype(np.float32)
+        batch_exclude = self.exclude_data[user_indices].toarray()
+        return list(zip(user_indices, batch_iteration, batch_exclude))
 
 
 class TrainUserRecDataset(TrainRecDataset):
@@ -218,7 +416,11 @@ class TrainUserRecDataset(TrainRecDataset):
         self.n_pos = n_pos
         self.name = 'TrainUserRecDataset'
 
-        del self.iteration_matrix
+        del self.interaction_user_idxs
+        del self.interaction_item_idxs
+
+        self._indptr = self.sampling_matrix.indptr
+        self._indices = self.sampling_matrix.indices
 
         logging.info(f'Built {self.name} module \n'
                      f'- n_pos: {self.n_pos} \n')
@@ -227,6 +429,11 @@ class TrainUserRecDataset(TrainRecDataset):
         return self.n_users
 
     def __getitem__(self, user_idx):
-        user_data = self.sampling_matrix[user_idx].indices
+        # Slicing the CSR arrays directly avoids creating a new sparse matrix for the user row
+        user_data = self._indices[self._indptr[user_idx]:self._indptr[user_idx + 1]]
         item_pos_idxs = np.random.choice(user_data, size=self.n_pos, replace=len(user_data) < self.n_pos)
         return user_idx, item_pos_idxs
+
+    def __getitems__(self, user_indices):
+        # Overrides TrainRecDataset.__getitems__, which indexes the (here deleted) interaction arrays
+        return [self[user_idx] for user_idx in user_indices]
@@ -1,12 +1,13 @@
 from functools import partial
 from typing import List
 
+import numpy as np
 import torch
 from torchinfo import summary
 
 from algorithms.algorithms_utils import AlgorithmsEnum
 from data.data_utils import DatasetsEnum, get_dataloader
-from data.dataset import RecDataset
+from data.dataset import RecDataset, clear_lhs_cache
 from eval.eval import FullEvaluator
 from eval.metrics import ndcg_at_k_batch
 from fair.fair_eval import FairEvaluator
@@ -16,19 +17,9 @@ summarize = partial(summary, col_names=['input_size', 'output_size', 'num_params
 
 
 def generate_log_str(fair_results, n_groups=2):
-    val_list = []
-
-    for i in range(n_groups):
-        val_list.append(fair_results[f'recall_group_{i}'])
-
     log_str = "Balanced Accuracy: {:.3f} ".format(fair_results['balanced_acc'])
 
-    recall_str = "("
-    for i, v in enumerate(val_list):
-        recall_str += "g{}: {:.3f}".format(i, v)
-        if i != len(val_list) - 1:
-            recall_str += " - "
-    recall_str += ")"
+    recall_str = "(" + " - ".join(f"g{i}: {fair_results[f'recall_group_{i}']:.3f}" for i in range(n_groups)) + ")"
 
     log_str += recall_str
     log_str += " - Unbalanced Accuracy: {:.3f}".format(fair_results['unbalanced_acc'])
@@ -36,20 +27,18 @@ def generate_log_str(fair_results, n_groups=2):
     return log_str
 
 
-def get_upsampling_values(train_mtx, n_groups, user_to_user_group, dataset_name: str, attribute: str):
+def get_upsampling_values(user_nnz, n_groups, user_to_user_group, dataset_name: str, attribute: str):
     """
     This function computes the upsampling values for the CrossEntropy Loss.
     For each group we compute the total # of interactions. A group receives as weight (# interactions of the group with
     the highest number of interactions) / (# interactions of the group).
+    :param user_nnz: # interactions of each user in the training data (see TrainRecDataset.user_nnz)
     """
 
-    ce_weights = torch.zeros(n_groups, dtype=torch.float)
+    # Single pass over the users: # interactions of each user summed by group
+    group_n_interactions = np.bincount(user_to_user_group.numpy(), weights=user_nnz, minlength=n_groups)
 
-    for group_idx in range(n_groups):
-        group_mask = user_to_user_group == group_idx
-        ce_weights[group_idx] = train_mtx[group_mask].sum()
-
-    ce_weights = ce_weights.max() / ce_weights
+    ce_weights = torch.from_numpy(group_n_interactions.max() / group_n_interactions).float()
 
     if dataset_name == 'lfm2bdemobias' and attribute == 'age':
         # Last class is outliers. We ignore it
@@ -81,6 +70,8 @@ def get_dataloaders(config: dict):
         'val': get_dataloader(config, 'val'),
         'test': get_dataloader(config, 'test')
     }
+    # The datasets are built, the parsed csv files are not needed anymore
+    clear_lhs_cache()
 
     return data_loaders
 
@@ -102,7 +93,7 @@ def get_user_group_data(train_dataset: RecDataset, dataset_name: str, group_type
 
     print(f"Analysis is carried on <{group_type}> with {n_groups} groups")
 
-    ce_weights = get_upsampling_values(train_mtx=train_dataset.sampling_matrix, n_groups=n_groups,
+    ce_weights = get_upsampling_values(user_nnz=train_dataset.user_nnz, n_groups=n_groups,
                                        user_to_user_group=user_to_user_group, dataset_name=dataset_name,
                                        attribute=group_type)
 
@@ -254,15 +245,8 @@ def get_users_gradient_scaling(train_dataset, method: str = 'none'):
     if method == 'none':
         return torch.ones(train_dataset.n_users, dtype=torch.float32)
     else:
-        train_mtx = train_dataset.sampling_matrix
-
-        n_user_updates = torch.tensor(train_mtx.sum(1).A1, dtype=torch.float32)
-        if method == 'mean':
-            n_user_updates = n_user_updates.mean() / n_user_updates
-        elif method == 'max':
-            n_user_updates = n_user_updates.max() / n_user_updates
-        elif method == 'min':
-            n_user_updates = n_user_updates.min() / n_user_updates
-        else:
+        n_user_updates = torch.from_numpy(train_dataset.user_nnz)
+        reducers = {'mean': n_user_updates.mean, 'max': n_user_updates.max, 'min': n_user_updates.min}
+        if method not in reducers:
             raise ValueError(f'Unknown method for gradient scaling: {method}')
-        return n_user_updates
+        return reducers[method]() / n_user_updates
@@ -38,7 +38,7 @@ def train_probe(probe_config: dict,
     })
 
     # For Training the probe, we just need the user indexes (with multiplicity according to the number of interactions)
-    u_idxs = torch.tensor(data_loaders['train'].dataset.iteration_matrix.row)  # Will be permuted later
+    u_idxs = torch.tensor(data_loaders['train'].dataset.interaction_user_idxs)  # Will be permuted later
 
     user_to_user_group, n_groups, ce_weights = get_user_group_data(
         train_dataset=data_loaders['train'].dataset,